@@ -4,13 +4,65 @@ Telegram Bot implementation for Supabase data extraction.
 
 import logging
 import asyncio
-from typing import Dict, Any, Set
-from telegram import Update
+import re
+from typing import Dict, Any, Set, Optional, Tuple
+from telegram import Message, Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from database import SupabaseManager
 
 logger = logging.getLogger(__name__)
 
+# Keywords for natural language queries, matched against message tokens
+_WORD_RE = re.compile(r"\w+")
+_SHOW_WORDS = frozenset({'show', 'get', 'fetch', 'retrieve', 'see', 'list'})
+_BOOKING_WORDS = frozenset(
+    {'booking', 'bookings', 'reservation', 'reservations'})
+_COUNT_WORDS = frozenset({'count', 'total'})
+
+# Fallback keys for booking fields, in order of preference
+_ROOM_KEYS = ('room_number', 'room')
+_DATE_KEYS = ('date', 'check_in', 'checkin_date')
+_TIME_KEYS = ('time', 'booking_time')
+_PACKAGE_KEYS = ('package', 'package_type')
+
+
+def _first(d: Dict[str, Any], keys: Tuple[str, ...], default: Any = 'N/A') -> Any:
+    """Return the value of the first key present in `d` with a non-None value."""
+    return next((d[k] for k in keys if d.get(k) is not None), default)
+
+
+def _is_dead_chat(error: Exception) -> bool:
+    """Whether a send error means the chat itself is gone or has blocked the bot."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+def _is_message_error(error: Exception) -> bool:
+    """Whether a send error is about the message itself, so every chat would fail."""
+    if not isinstance(error, BadRequest):
+        return False
+    text = str(error).lower()
+    return any(reason in text for reason in (
+        "can't parse entities", 'message is too long', 'message text is empty'))
+
+
+class _RateLimiter:
+    """Spaces calls evenly so that at most `rate` start per second."""
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        """Wait for the next free slot."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
 
 class TelegramBot:
     """Main Telegram bot class."""
@@ -20,33 +72,48 @@ class TelegramBot:
         self.bot_token = bot_token
         self.db_manager = SupabaseManager(supabase_url, supabase_key)
         self.application = None
-        self.known_booking_ids: Set[str] = set()
+        self._last_seen_ts: Optional[str] = None  # created_at of the newest booking seen
         self.subscribers: Set[int] = set()  # Chat IDs for notifications
+        # Fallback poll interval (seconds), backs off while no bookings arrive
+        self._poll_min = 5
+        self._poll_max = 300
+        self._poll_interval = self._poll_min
+        self._wake = asyncio.Event()  # Set to cut the current wait short
+        self._monitor_task: Optional[asyncio.Task] = None
+        self._catch_up_pending = False  # Set when realtime (re)joins
+        # Strong references to fire-and-forget tasks so they aren't garbage-collected
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Telegram allows bots about 30 messages per second overall
+        self._send_limiter = _RateLimiter(30)
+        self._send_retries = 3
+
+    def _build_application(self):
+        """Create the Telegram application and register all handlers."""
+        # Create application
+        self.application = Application.builder().token(self.bot_token).build()
+
+        # Add command handlers
+        self.application.add_handler(
+            CommandHandler("start", self.start_command))
+        self.application.add_handler(
+            CommandHandler("help", self.help_command))
+        self.application.add_handler(
+            CommandHandler("bookings", self.bookings_command))
+        self.application.add_handler(
+            CommandHandler("notifications", self.notifications_command))
+        self.application.add_handler(
+            CommandHandler("stop_notifications",
+                           self.stop_notifications_command))
+
+        # Add message handler for conversational queries
+        self.application.add_handler(
+            MessageHandler(filters.TEXT & ~filters.COMMAND,
+                           self.handle_message))
 
     async def start(self):
         """Start the bot and begin polling for updates."""
         try:
-            # Create application
-            self.application = Application.builder().token(
-                self.bot_token).build()
-
-            # Add command handlers
-            self.application.add_handler(
-                CommandHandler("start", self.start_command))
-            self.application.add_handler(
-                CommandHandler("help", self.help_command))
-            self.application.add_handler(
-                CommandHandler("bookings", self.bookings_command))
-            self.application.add_handler(
-                CommandHandler("notifications", self.notifications_command))
-            self.application.add_handler(
-                CommandHandler("stop_notifications",
-                               self.stop_notifications_command))
-
-            # Add message handler for conversational queries
-            self.application.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND,
-                               self.handle_message))
+            self._build_application()
 
             # Start polling
             logger.info("Starting bot...")
@@ -56,11 +123,12 @@ class TelegramBot:
             await self.application.start()
 
             # Start the notification monitoring task
-            asyncio.create_task(self.monitor_new_bookings())
+            self._monitor_task = asyncio.create_task(
+                self.monitor_new_bookings())
 
             # Start polling
             await self.application.updater.start_polling(
-                drop_pending_updates=True)
+                drop_pending_updates=True, **self._polling_kwargs())
             await self.application.updater.idle()
 
         except Exception as e:
@@ -70,44 +138,60 @@ class TelegramBot:
     def start_sync(self):
         """Start the bot synchronously."""
         try:
-            # Create application
-            self.application = Application.builder().token(
-                self.bot_token).build()
-
-            # Add command handlers
-            self.application.add_handler(
-                CommandHandler("start", self.start_command))
-            self.application.add_handler(
-                CommandHandler("help", self.help_command))
-            self.application.add_handler(
-                CommandHandler("bookings", self.bookings_command))
-            self.application.add_handler(
-                CommandHandler("notifications", self.notifications_command))
-            self.application.add_handler(
-                CommandHandler("stop_notifications",
-                               self.stop_notifications_command))
-
-            # Add message handler for conversational queries
-            self.application.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND,
-                               self.handle_message))
+            self._build_application()
 
             # Start polling synchronously
             logger.info("Starting bot...")
 
-            # Start monitoring task in background thread
-            import threading
-            monitoring_thread = threading.Thread(
-                target=self._start_monitoring_sync)
-            monitoring_thread.daemon = True
-            monitoring_thread.start()
+            # Start monitoring on PTB's own event loop once it is running
+            self.application.post_init = self._post_init
+            self.application.post_stop = self._post_stop
+
+            self.application.run_polling(drop_pending_updates=True,
+                                         **self._polling_kwargs())
+
+        except Exception as e:
+            logger.error(f"Error starting bot: {e}")
+            raise
+
+    def start_webhook(self, listen: str, port: int, webhook_url: str,
+                      secret_token: Optional[str] = None):
+        """Start the bot with a webhook, for deployments behind a reverse proxy.
+
+        `webhook_url` is the public base URL; updates are received on
+        `<webhook_url>/<bot token>`.
+        """
+        try:
+            self._build_application()
+
+            logger.info("Starting bot with webhook...")
 
-            self.application.run_polling(drop_pending_updates=True)
+            # Start monitoring on PTB's own event loop once it is running
+            self.application.post_init = self._post_init
+            self.application.post_stop = self._post_stop
+
+            self.application.run_webhook(
+                listen=listen,
+                port=port,
+                url_path=self.bot_token,
+                webhook_url=f"{webhook_url.rstrip('/')}/{self.bot_token}",
+                secret_token=secret_token,
+                allowed_updates=[Update.MESSAGE],
+                drop_pending_updates=True)
 
         except Exception as e:
             logger.error(f"Error starting bot: {e}")
             raise
 
+    @staticmethod
+    def _polling_kwargs() -> Dict[str, Any]:
+        """Long polling settings: hold getUpdates open and only ask for messages."""
+        return {
+            'timeout': 30,
+            'poll_interval': 0.0,
+            'allowed_updates': [Update.MESSAGE],
+        }
+
     async def start_command(self, update: Update,
                             context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command."""
@@ -169,10 +253,13 @@ I'll automatically alert you when new bookings are created! 🔔
             return
 
         try:
-            bookings = await self.db_manager.get_all_bookings()
+            # Only the 10 shown are fetched; the total comes from a HEAD count
+            bookings, total = await asyncio.gather(
+                self.db_manager.get_all_bookings(limit=10),
+                self.db_manager.count_bookings())
             if bookings:
                 formatted_bookings = self._format_bookings_for_display(
-                    bookings)
+                    bookings, total)
                 await update.message.reply_text(formatted_bookings,
                                                 parse_mode='Markdown')
             else:
@@ -198,6 +285,7 @@ I'll automatically alert you when new bookings are created! 🔔
                 "🔔 You're already subscribed to booking notifications!")
         else:
             self.subscribers.add(chat_id)
+            self.wake()
             await update.message.reply_text(
                 "✅ Booking notifications enabled! I'll alert you when new bookings are created.",
                 parse_mode='Markdown')
@@ -220,56 +308,127 @@ I'll automatically alert you when new bookings are created! 🔔
                 "🔕 You weren't subscribed to notifications.")
         logger.info(f"User {chat_id} unsubscribed from notifications")
 
-    def _start_monitoring_sync(self):
-        """Start monitoring in a separate thread for synchronous bot."""
-        import asyncio
+    async def _post_init(self, application: Application):
+        """Schedule booking monitoring after the application is initialized."""
+        # Application.create_task would warn here since the app isn't running yet
+        self._monitor_task = asyncio.create_task(self.monitor_new_bookings())
+
+    async def _post_stop(self, application: Application):
+        """Stop booking monitoring and close realtime when the application stops."""
+        tasks = list(self._background_tasks)
+        if self._monitor_task is not None:
+            tasks.append(self._monitor_task)
+            self._monitor_task = None
+
+        # The loop is closed right after this, so nothing may be left pending
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
         try:
-            # Create new event loop for this thread
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.monitor_new_bookings())
+            await self.db_manager.realtime.close()
         except Exception as e:
-            logger.error(f"Error in sync monitoring: {e}")
+            logger.error(f"Error closing realtime connection: {e}")
 
     async def monitor_new_bookings(self):
-        """Monitor for new bookings and send notifications."""
+        """Monitor for new bookings via Supabase Realtime, polling only while disconnected."""
         logger.info("Starting booking monitoring...")
 
         while True:
             try:
-                # Get current bookings
-                current_bookings = await self.db_manager.get_all_bookings()
+                connected = self.db_manager.realtime_connected
+                if self._catch_up_pending or not connected:
+                    # Catch up on anything inserted while the channel wasn't joined
+                    self._catch_up_pending = False
+                    found_new = await self._poll_new_bookings()
+                    self._adjust_poll_interval(found_new)
 
-                # Check for new bookings
-                if current_bookings:
-                    current_ids = {
-                        str(booking.get('id', ''))
-                        for booking in current_bookings
-                    }
+                if not connected:
+                    await self.db_manager.subscribe_new_bookings(
+                        self._on_booking_insert, self._on_realtime_subscribed)
 
-                    # Find new booking IDs
-                    new_booking_ids = current_ids - self.known_booking_ids
+            except Exception as e:
+                logger.error(f"Error in booking monitoring: {e}")
 
-                    if new_booking_ids and self.known_booking_ids:  # Don't notify on first run
-                        # Get details of new bookings
-                        new_bookings = [
-                            b for b in current_bookings
-                            if str(b.get('id', '')) in new_booking_ids
-                        ]
+            # While subscribed only the websocket health is checked here, inserts
+            # arrive via callback; otherwise this is the fallback poll interval
+            if self.db_manager.realtime_connected:
+                await self._wait_or_wake(30)
+            else:
+                await self._wait_or_wake(self._poll_interval)
 
-                        # Send notifications to subscribers
-                        for booking in new_bookings:
-                            await self._notify_new_booking(booking)
+    async def _wait_or_wake(self, timeout: float):
+        """Sleep for up to `timeout` seconds, returning early if wake() is called."""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    def _adjust_poll_interval(self, found_new: bool):
+        """Reset the poll interval on activity, otherwise back off towards the max."""
+        if found_new:
+            self._poll_interval = self._poll_min
+        else:
+            self._poll_interval = min(
+                self._poll_max, self._poll_interval +
+                (self._poll_max - self._poll_min) / 10)
+
+    def wake(self):
+        """Reset the fallback poll interval and check for new bookings right away."""
+        self._poll_interval = self._poll_min
+        self._wake.set()
+
+    def _on_realtime_subscribed(self):
+        """Realtime callback for each (re)join: poll once from the watermark."""
+        self._catch_up_pending = True
+        self._wake.set()
+
+    def _on_booking_insert(self, payload: Dict[str, Any]):
+        """Realtime callback for INSERTs on the bookings table."""
+        booking = payload.get('new') or payload.get('data', {}).get('record')
+        if not booking:
+            return
 
-                    # Update known booking IDs
-                    self.known_booking_ids = current_ids
+        if booking.get('created_at'):
+            self._advance_watermark(str(booking['created_at']))
+        task = asyncio.create_task(self._notify_new_booking(booking))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
 
-                # Wait before next check (30 seconds)
-                await asyncio.sleep(30)
+    async def _poll_new_bookings(self) -> bool:
+        """Fallback poll for bookings newer than the last one seen.
 
-            except Exception as e:
-                logger.error(f"Error in booking monitoring: {e}")
-                await asyncio.sleep(60)  # Wait longer on error
+        Returns True if any new bookings were found.
+        """
+        if self._last_seen_ts is None:  # Don't notify on first run
+            latest = await self.db_manager.get_recent_bookings(limit=1)
+            self._last_seen_ts = str(
+                latest[0]['created_at']) if latest else '1970-01-01T00:00:00+00:00'
+            return False
+
+        new_bookings = await self.db_manager.get_bookings_since(
+            self._last_seen_ts, columns='*')
+        if not new_bookings:
+            return False
+
+        # Rows are already filtered server-side, and a batch insert can share one
+        # created_at (now() is per transaction), so notify all and move the
+        # watermark once rather than re-filtering row by row
+        self._advance_watermark(
+            max((str(b['created_at']) for b in new_bookings if b.get('created_at')),
+                default=None))
+
+        # Oldest first so notifications arrive in booking order
+        for booking in reversed(new_bookings):
+            await self._notify_new_booking(booking)
+        return True
+
+    def _advance_watermark(self, created_at: Optional[str]):
+        """Move the watermark forward to `created_at`, never backwards."""
+        if created_at and (self._last_seen_ts is None
+                           or created_at > self._last_seen_ts):
+            self._last_seen_ts = created_at
 
     async def _notify_new_booking(self, booking: Dict[str, Any]):
         """Send notification about a new booking to all subscribers."""
@@ -277,24 +436,70 @@ I'll automatically alert you when new bookings are created! 🔔
             booking_info = self._format_single_booking(booking)
             message = f"🎆 **New Booking Alert!**\n\n{booking_info}"
 
-            # Send to all subscribers
-            for chat_id in self.subscribers.copy(
-            ):  # Use copy to avoid modification during iteration
+            if not (self.application and self.application.bot):
+                return
+
+            snapshot = tuple(self.subscribers)
+            dead: Set[int] = set()
+
+            def record_failure(chat_id: int, error: Exception):
+                logger.error(f"Failed to send notification to {chat_id}: {error}")
+                if _is_dead_chat(error):
+                    dead.add(chat_id)
+
+            # Send (and parse the Markdown) once, then copy it to the rest.
+            # A failure with one chat moves on to the next; only an error about
+            # the message itself (e.g. a Markdown parse error) would fail for all.
+            source = None
+            for i, chat_id in enumerate(snapshot):
                 try:
-                    if self.application and self.application.bot:
-                        await self.application.bot.send_message(
-                            chat_id=chat_id,
-                            text=message,
-                            parse_mode='Markdown')
+                    source = await self._send_notification(chat_id, message)
+                    break
                 except Exception as e:
-                    logger.error(
-                        f"Failed to send notification to {chat_id}: {e}")
-                    # Remove invalid chat IDs
-                    self.subscribers.discard(chat_id)
+                    record_failure(chat_id, e)
+                    if _is_message_error(e):
+                        break
+
+            if source is not None:
+                remaining = snapshot[i + 1:]
+                results = await asyncio.gather(
+                    *(self._copy_notification(chat_id, source)
+                      for chat_id in remaining),
+                    return_exceptions=True)
+                for chat_id, result in zip(remaining, results):
+                    if isinstance(result, Exception):
+                        record_failure(chat_id, result)
+
+            # Remove invalid chat IDs
+            self.subscribers -= dead
 
         except Exception as e:
             logger.error(f"Error formatting booking notification: {e}")
 
+    async def _send_notification(self, chat_id: int, message: str) -> Message:
+        """Send a notification message to one chat, respecting the rate limit."""
+        return await self._rate_limited(lambda: self.application.bot.send_message(
+            chat_id=chat_id, text=message, parse_mode='Markdown'))
+
+    async def _copy_notification(self, chat_id: int, source: Message):
+        """Copy an already sent notification to another chat."""
+        await self._rate_limited(lambda: self.application.bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=source.chat_id,
+            message_id=source.message_id))
+
+    async def _rate_limited(self, call):
+        """Run a Bot API call within the send rate, retrying when Telegram asks to wait."""
+        for attempt in range(self._send_retries):
+            await self._send_limiter.acquire()
+            try:
+                return await call()
+            except RetryAfter as e:
+                if attempt == self._send_retries - 1:
+                    raise
+                logger.warning(f"Rate limited by Telegram, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+
     async def handle_message(self, update: Update,
                              context: ContextTypes.DEFAULT_TYPE):
         """Handle natural language messages."""
@@ -302,15 +507,17 @@ I'll automatically alert you when new bookings are created! 🔔
             return
 
         message_text = update.message.text.lower()
+        tokens = set(_WORD_RE.findall(message_text))
+        mentions_bookings = not _BOOKING_WORDS.isdisjoint(tokens)
 
         # Simple natural language processing for bookings
-        if any(word in message_text for word in
-               ['show', 'get', 'fetch', 'retrieve', 'see', 'list']):
-            if any(word in message_text for word in
-                   ['booking', 'bookings', 'reservation', 'reservations']):
+        if not _SHOW_WORDS.isdisjoint(tokens):
+            if mentions_bookings:
                 # Show bookings
                 try:
-                    bookings = await self.db_manager.get_all_bookings()
+                    bookings, total = await asyncio.gather(
+                        self.db_manager.get_all_bookings(limit=10),
+                        self.db_manager.count_bookings())
 
                     if not bookings:
                         await update.message.reply_text(
@@ -318,7 +525,7 @@ I'll automatically alert you when new bookings are created! 🔔
                         return
 
                     formatted_bookings = self._format_bookings_for_display(
-                        bookings)
+                        bookings, total)
                     await update.message.reply_text(formatted_bookings,
                                                     parse_mode='Markdown')
 
@@ -335,10 +542,8 @@ I'll automatically alert you when new bookings are created! 🔔
                     "• 'show bookings' or 'list reservations'\n"
                     "• `/notifications` - to get notified of new bookings")
 
-        elif any(word in message_text
-                 for word in ['count', 'how many', 'total']):
-            if any(word in message_text for word in
-                   ['booking', 'bookings', 'reservation', 'reservations']):
+        elif not _COUNT_WORDS.isdisjoint(tokens) or 'how many' in message_text:
+            if mentions_bookings:
                 try:
                     count = await self.db_manager.count_bookings()
                     await update.message.reply_text(
@@ -369,10 +574,12 @@ I'll automatically alert you when new bookings are created! 🔔
         if not data:
             return f"No data found in table '{table_name}'."
 
-        message = f"📊 **Data from '{table_name}' (showing {len(data)} rows):**\n\n"
+        header = f"📊 **Data from '{table_name}' (showing {len(data)} rows):**\n\n"
+        parts: list[str] = [header]
+        length = len(header)
 
         for i, row in enumerate(data[:10], 1):  # Limit to 10 rows
-            message += f"**Row {i}:**\n"
+            row_parts = [f"**Row {i}:**\n"]
 
             # Format each field in the row
             for key, value in row.items():
@@ -381,49 +588,61 @@ I'll automatically alert you when new bookings are created! 🔔
                 if len(str_value) > 50:
                     str_value = str_value[:47] + "..."
 
-                message += f"• *{key}*: {str_value}\n"
+                row_parts.append(f"• *{key}*: {str_value}\n")
 
-            message += "\n"
+            row_parts.append("\n")
+            row_text = "".join(row_parts)
+            parts.append(row_text)
+            length += len(row_text)
 
             # Telegram message length limit
-            if len(message) > 3000:
-                message += "... (truncated due to length limit)\n"
+            if length > 3000:
+                parts.append("... (truncated due to length limit)\n")
                 break
 
         if len(data) > 10:
-            message += f"\n*Note: Showing first 10 rows out of {len(data)} total rows.*"
+            parts.append(
+                f"\n*Note: Showing first 10 rows out of {len(data)} total rows.*")
 
-        return message
+        return "".join(parts)
 
-    def _format_bookings_for_display(self, bookings: list) -> str:
-        """Format booking data for Telegram display."""
+    def _format_bookings_for_display(self, bookings: list,
+                                     total: Optional[int] = None) -> str:
+        """Format booking data for Telegram display.
+
+        `total` is the full booking count when `bookings` is only the first page.
+        """
         if not bookings:
             return "📅 No bookings found."
 
-        message = f"📅 **Current Bookings ({len(bookings)} total):**\n\n"
+        total = max(total or 0, len(bookings))
+        header = f"📅 **Current Bookings ({total} total):**\n\n"
+        parts: list[str] = [header]
+        length = len(header)
 
         for i, booking in enumerate(bookings[:10], 1):  # Limit to 10 bookings
             booking_info = self._format_single_booking(booking)
-            message += f"**Booking {i}:**\n{booking_info}\n\n"
+            part = f"**Booking {i}:**\n{booking_info}\n\n"
+            parts.append(part)
+            length += len(part)
 
             # Telegram message length limit
-            if len(message) > 3000:
-                message += "... (showing first 10 bookings)\n"
+            if length > 3000:
+                parts.append("... (showing first 10 bookings)\n")
                 break
 
-        if len(bookings) > 10:
-            message += f"\n*Showing 10 of {len(bookings)} total bookings.*"
+        if total > 10:
+            parts.append(f"\n*Showing 10 of {total} total bookings.*")
 
-        return message
+        return "".join(parts)
 
     def _format_single_booking(self, booking: Dict[str, Any]) -> str:
         """Format a single booking for display - only room number, date, time, and package."""
         # Extract only the required fields
-        room = booking.get('room_number', booking.get('room', 'N/A'))
-        date = booking.get(
-            'date', booking.get('check_in', booking.get('checkin_date','N/A')))
-        time = booking.get('time', booking.get('booking_time', 'N/A'))
-        package = booking.get('package', booking.get('package_type', 'N/A'))
+        room = _first(booking, _ROOM_KEYS)
+        date = _first(booking, _DATE_KEYS)
+        time = _first(booking, _TIME_KEYS)
+        package = _first(booking, _PACKAGE_KEYS)
 
         booking_info = f"• *Room*: {room}\n"
         booking_info += f"• *Date*: {date}\n"
@@ -2,11 +2,20 @@
 Supabase database manager for the Telegram bot.
 """
 
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
+import re
+import time
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from supabase import create_client, Client
+from realtime import AsyncRealtimeClient, RealtimeSubscribeStates
 
 logger = logging.getLogger(__name__)
+# realtime logs every websocket frame (heartbeats, full insert payloads) at INFO
+logging.getLogger('realtime').setLevel(logging.WARNING)
+
+# Allowed table and column identifiers
+_IDENT_RE = re.compile(r'\A[A-Za-z_][A-Za-z0-9_]*\Z')
 
 class SupabaseManager:
     """Manages Supabase database operations."""
@@ -15,8 +24,17 @@ class SupabaseManager:
         """Initialize Supabase client."""
         self.url = supabase_url
         self.key = supabase_key
-        self.client: Client = create_client(supabase_url, supabase_key)
+        self.client: Client
         self._connect()
+        self.realtime = AsyncRealtimeClient(
+            f"{supabase_url}/realtime/v1", supabase_key, auto_reconnect=True)
+        self._bookings_channel = None  # Set only once the join is acknowledged
+        self._bookings_join = None  # Channel whose join is pending or last attempted
+        self._booking_table: Optional[str] = None
+        # Short-lived cache of get_all_bookings results, keyed by (columns, limit)
+        self._bookings_cache_ttl = 3.0
+        self._bookings_cache: Dict[Tuple[str, Optional[int]], Tuple[float, List[Dict[str, Any]]]] = {}
+        self._bookings_inflight: Dict[Tuple[str, Optional[int]], asyncio.Future] = {}
     
     def _connect(self):
         """Establish connection to Supabase."""
@@ -67,8 +85,10 @@ class SupabaseManager:
             if not table_name or not table_name.strip():
                 raise ValueError("Table name cannot be empty")
             
-            # Sanitize table name to prevent injection
-            table_name = table_name.strip().replace(';', '').replace('--', '')
+            # Validate table name to prevent injection
+            table_name = table_name.strip()
+            if not _IDENT_RE.match(table_name):
+                raise ValueError(f"Invalid table name: {table_name!r}")
             
             response = self.client.from_(table_name).select('*').limit(limit).execute()
             
@@ -87,12 +107,15 @@ class SupabaseManager:
             if not table_name or not table_name.strip():
                 raise ValueError("Table name cannot be empty")
             
-            # Sanitize table name
-            table_name = table_name.strip().replace(';', '').replace('--', '')
+            # Validate table name to prevent injection
+            table_name = table_name.strip()
+            if not _IDENT_RE.match(table_name):
+                raise ValueError(f"Invalid table name: {table_name!r}")
             
-            response = self.client.from_(table_name).select('*').execute()
+            # HEAD request: PostgREST returns the count in Content-Range with no body
+            response = self.client.from_(table_name).select('*', count='exact', head=True).execute()
             
-            return len(response.data) if response.data is not None else 0
+            return response.count if response.count is not None else 0
             
         except Exception as e:
             logger.error(f"Error counting rows in table {table_name}: {e}")
@@ -113,16 +136,20 @@ class SupabaseManager:
             if not table_name or not table_name.strip():
                 raise ValueError("Table name cannot be empty")
             
-            # Sanitize table name
-            table_name = table_name.strip().replace(';', '').replace('--', '')
+            # Validate table name to prevent injection
+            table_name = table_name.strip()
+            if not _IDENT_RE.match(table_name):
+                raise ValueError(f"Invalid table name: {table_name!r}")
             
             query = self.client.from_(table_name).select(columns)
             
             # Apply filters if provided
             if filters is not None:
                 for column, value in filters.items():
-                    # Sanitize column name
-                    column = column.strip().replace(';', '').replace('--', '')
+                    # Validate column name
+                    column = column.strip()
+                    if not _IDENT_RE.match(column):
+                        raise ValueError(f"Invalid column name: {column!r}")
                     query = query.eq(column, value)
             
             response = query.limit(limit).execute()
@@ -133,75 +160,204 @@ class SupabaseManager:
             logger.error(f"Error executing custom query on table {table_name}: {e}")
             raise Exception(f"Failed to execute custom query: {str(e)}")
     
-    def test_connection(self) -> bool:
-        """Test the database connection."""
+    @property
+    def realtime_connected(self) -> bool:
+        """Whether the Realtime websocket is up and the bookings channel is currently joined."""
+        return (self._bookings_channel is not None and self._bookings_channel.is_joined
+                and self.realtime.is_connected)
+    
+    async def subscribe_new_bookings(self, callback: Callable[[Dict[str, Any]], None],
+                                     on_subscribed: Optional[Callable[[], None]] = None):
+        """
+        Subscribe to INSERT events on the bookings table via Supabase Realtime.
+        
+        The callback receives the raw change payload; the inserted row is under 'new'.
+        on_subscribed is called on every successful (re)join, so callers can catch up on
+        inserts missed while the channel was down. realtime_connected is only True while
+        the channel is joined, so callers can fall back to polling otherwise.
+        """
+        try:
+            reconnected = not self.realtime.is_connected
+            if reconnected:
+                await self.realtime.connect()
+            
+            # connect() doesn't rejoin existing channels (only the client's own
+            # auto-reconnect does), and a failed join must be rebuilt from scratch
+            if reconnected or self._bookings_channel is None:
+                await self._remove_bookings_channel()
+                
+                table_name = await self._resolve_booking_table()
+                if table_name is None:
+                    raise ValueError("No booking table found")
+                
+                channel = self.realtime.channel(table_name)
+                channel.on_postgres_changes(
+                    'INSERT', schema='public', table=table_name, callback=callback)
+                self._bookings_join = channel
+                
+                def on_state(state: RealtimeSubscribeStates, error: Optional[Exception]):
+                    if channel is not self._bookings_join:
+                        return  # A channel we already replaced
+                    
+                    if state == RealtimeSubscribeStates.SUBSCRIBED:
+                        self._bookings_channel = channel
+                        logger.info("Subscribed to realtime booking inserts")
+                        if on_subscribed is not None:
+                            on_subscribed()
+                    else:
+                        self._bookings_channel = None
+                        logger.warning(f"Realtime booking channel {state}: {error}")
+                
+                await channel.subscribe(on_state)
+            
+        except Exception as e:
+            logger.error(f"Error subscribing to booking changes: {e}")
+            raise Exception(f"Failed to subscribe to booking changes: {str(e)}")
+    
+    async def _remove_bookings_channel(self):
+        """Forget the current bookings channel and remove it from the realtime client."""
+        channel = self._bookings_join
+        self._bookings_join = None
+        self._bookings_channel = None
+        
+        if channel is not None:
+            try:
+                await self.realtime.remove_channel(channel)
+            except Exception as e:
+                logger.debug(f"Could not remove stale bookings channel: {e}")
+    
+    async def test_connection(self) -> bool:
+        """Test the database connection with a HEAD count on the booking table."""
         try:
-            # Try a simple operation to test connection
-            self.client.from_('test_connection').select('1').limit(1).execute()
+            table_name = await self._resolve_booking_table()
+            if table_name is None:
+                logger.error("Connection test failed: no booking table found")
+                return False
+            
+            await asyncio.to_thread(
+                self.client.from_(table_name).select('*', count='exact', head=True).execute)
             return True
         except Exception as e:
             logger.error(f"Connection test failed: {e}")
             return False
     
-    async def get_all_bookings(self) -> List[Dict[str, Any]]:
-        """Get all bookings from the bookings table."""
+    async def _resolve_booking_table(self) -> Optional[str]:
+        """Find which of the common booking table names exists, caching the result."""
+        if self._booking_table is not None:
+            return self._booking_table
+        
+        # Try common booking table names
+        table_names = ['bookings', 'reservations', 'booking', 'reservation']
+        
+        for table_name in table_names:
+            try:
+                response = await asyncio.to_thread(
+                    self.client.from_(table_name).select('*').limit(1).execute)
+                
+                if response.data is not None:
+                    logger.info(f"Using booking table '{table_name}'")
+                    self._booking_table = table_name
+                    return table_name
+            except Exception as table_error:
+                logger.debug(f"Table '{table_name}' not found or accessible: {table_error}")
+                continue
+        
+        logger.warning("No booking table found. Tried: bookings, reservations, booking, reservation")
+        return None
+    
+    async def get_all_bookings(self, columns: str = '*', limit: Optional[int] = 100) -> List[Dict[str, Any]]:
+        """
+        Get bookings from the bookings table, newest first, selecting only the given columns.
+        
+        Results are cached for a few seconds and concurrent callers share a single request.
+        Each caller gets its own list, but the row dicts are shared and must not be mutated.
+        """
+        key = (columns, limit)
+        
+        cached = self._bookings_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self._bookings_cache_ttl:
+            return list(cached[1])
+        
+        inflight = self._bookings_inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._fetch_bookings(columns, limit))
+            self._bookings_inflight[key] = inflight
+            inflight.add_done_callback(lambda _: self._bookings_inflight.pop(key, None))
+        
+        # Shield so one cancelled caller doesn't cancel the fetch for the others
+        return list(await asyncio.shield(inflight))
+    
+    async def _fetch_bookings(self, columns: str, limit: Optional[int]) -> List[Dict[str, Any]]:
+        """Fetch bookings from the database and store them in the cache."""
         try:
-            # Try common booking table names
-            table_names = ['bookings', 'reservations', 'booking', 'reservation']
+            table_name = await self._resolve_booking_table()
+            if table_name is None:
+                return []
             
-            for table_name in table_names:
-                try:
-                    response = self.client.from_(table_name).select('*').order('created_at', desc=True).execute()
-                    
-                    if response.data is not None:
-                        logger.info(f"Found {len(response.data)} bookings in table '{table_name}'")
-                        return response.data
-                except Exception as table_error:
-                    logger.debug(f"Table '{table_name}' not found or accessible: {table_error}")
-                    continue
+            query = self.client.from_(table_name).select(columns).order('created_at', desc=True)
+            if limit is not None:
+                query = query.limit(limit)
+            
+            # Run the blocking HTTP call off the event loop so other callers can join it
+            response = await asyncio.to_thread(query.execute)
+            
+            data = response.data if response.data is not None else []
+            self._bookings_cache[(columns, limit)] = (time.monotonic(), data)
             
-            # If no standard table found, return empty list
-            logger.warning("No booking table found. Tried: bookings, reservations, booking, reservation")
-            return []
+            logger.info(f"Found {len(data)} bookings in table '{table_name}'")
+            return data
             
         except Exception as e:
             logger.error(f"Error getting bookings: {e}")
             raise Exception(f"Failed to retrieve bookings: {str(e)}")
     
+    async def get_all_bookings_full(self, columns: str = '*') -> List[Dict[str, Any]]:
+        """Get every booking without a row limit. Only for code paths that need the whole table."""
+        return await self.get_all_bookings(columns, limit=None)
+    
     async def get_recent_bookings(self, limit: int = 10) -> List[Dict[str, Any]]:
         """Get recent bookings with a limit."""
         try:
-            table_names = ['bookings', 'reservations', 'booking', 'reservation']
+            table_name = await self._resolve_booking_table()
+            if table_name is None:
+                return []
             
-            for table_name in table_names:
-                try:
-                    response = self.client.from_(table_name).select('*').order('created_at', desc=True).limit(limit).execute()
-                    
-                    if response.data is not None:
-                        return response.data
-                except Exception:
-                    continue
+            response = await asyncio.to_thread(
+                self.client.from_(table_name).select('*').order('created_at', desc=True).limit(limit).execute)
             
-            return []
+            return response.data if response.data is not None else []
             
         except Exception as e:
             logger.error(f"Error getting recent bookings: {e}")
             raise Exception(f"Failed to retrieve recent bookings: {str(e)}")
     
+    async def get_bookings_since(self, created_after: str, columns: str = '*') -> List[Dict[str, Any]]:
+        """Get bookings created strictly after the given timestamp, newest first."""
+        try:
+            table_name = await self._resolve_booking_table()
+            if table_name is None:
+                return []
+            
+            response = await asyncio.to_thread(
+                self.client.from_(table_name).select(columns).gt('created_at', created_after).order('created_at', desc=True).execute)
+            
+            return response.data if response.data is not None else []
+            
+        except Exception as e:
+            logger.error(f"Error getting bookings since {created_after}: {e}")
+            raise Exception(f"Failed to retrieve new bookings: {str(e)}")
+    
     async def count_bookings(self) -> int:
         """Count total number of bookings."""
         try:
-            table_names = ['bookings', 'reservations', 'booking', 'reservation']
+            table_name = await self._resolve_booking_table()
+            if table_name is None:
+                return 0
             
-            for table_name in table_names:
-                try:
-                    response = self.client.from_(table_name).select('*').execute()
-                    if response.data is not None:
-                        return len(response.data)
-                except Exception:
-                    continue
+            response = await asyncio.to_thread(
+                self.client.from_(table_name).select('*', count='exact', head=True).execute)
             
-            return 0
+            return response.count if response.count is not None else 0
             
         except Exception as e:
             logger.error(f"Error counting bookings: {e}")
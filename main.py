@@ -36,7 +36,17 @@ def main():
         
         # Initialize and start the bot
         telegram_bot = TelegramBot(bot_token, supabase_url, supabase_key)
-        telegram_bot.start_sync()
+        
+        # Use a webhook when a public URL is configured, otherwise poll
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            telegram_bot.start_webhook(
+                listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+                port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                webhook_url=webhook_url,
+                secret_token=os.getenv('WEBHOOK_SECRET'))
+        else:
+            telegram_bot.start_sync()
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")